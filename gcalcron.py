@@ -13,7 +13,6 @@ from __future__ import division
 from __future__ import absolute_import
 
 import argparse
-import httplib2
 import os
 import sys
 import json
@@ -21,7 +20,9 @@ import datetime
 import dateutil.parser
 import subprocess
 import re
+import shlex
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Google API
 from builtins import open
@@ -30,6 +31,7 @@ from builtins import str
 from builtins import input
 from builtins import object
 from apiclient import discovery
+from apiclient.http import build_http
 from oauth2client import file
 from oauth2client import client
 from oauth2client import tools
@@ -40,6 +42,21 @@ standard_library.install_aliases()
 
 logger = logging.getLogger(__name__)
 
+# Files are looked up next to this script, resolved once at import time
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_CREDENTIALS_FILE = os.path.join(_BASE_DIR, 'credentials.dat')
+_LOG_FILE = os.path.join(_BASE_DIR, 'gcalcron.log')
+_GCALCRON_SH = os.path.join(_BASE_DIR, 'gcalcron.sh')
+
+# Job id printed by "at" on stderr when a job is scheduled
+_JOB_RE = re.compile(rb'job (\d+) at')
+
+# Month abbreviations understood by "at", independent of the locale
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# Calendar service object shared by all the adapters of the process
+_service = None
+
 # Parser for command-line arguments.
 parser = argparse.ArgumentParser(
     description=__doc__,
@@ -59,7 +76,7 @@ class GCalAdapter(object):
     # application, including client_id and client_secret. You can see the Client ID
     # and Client secret on the APIs page in the Cloud Console:
     # <https://cloud.google.com/console#/project/395452703880/apiui>
-    CLIENT_SECRETS = os.path.join(os.path.dirname(__file__), 'client_secrets.json')
+    CLIENT_SECRETS = os.path.join(_BASE_DIR, 'client_secrets.json')
 
     def __init__(self, calendar_id=None, flags=None):
         self.calendarId = calendar_id
@@ -67,11 +84,14 @@ class GCalAdapter(object):
         self.service = None
 
     def get_service(self):
+        global _service
+        if not self.service and _service:
+            self.service = _service
         if not self.service:
             # If the credentials don't exist or are invalid run through the native client
             # flow. The Storage object will ensure that if successful the good
             # credentials will get written back to the file.
-            storage = file.Storage(os.path.join(os.path.dirname(__file__), 'credentials.dat'))
+            storage = file.Storage(_CREDENTIALS_FILE)
             credentials = storage.get()
             if credentials is None or credentials.invalid:
                 # Set up a Flow object to be used for authentication.
@@ -87,11 +107,17 @@ class GCalAdapter(object):
                 credentials = tools.run_flow(flow, storage, self.flags)
 
             # Create an httplib2.Http object to handle our HTTP requests and authorize it
-            # with our good Credentials.
-            http = httplib2.Http()
+            # with our good Credentials. It is kept by the service object, so all the batch
+            # requests share its keep-alive connection to the API host.
+            http = build_http()
+            if credentials.access_token_expired:
+                # Refresh the stored access token upfront instead of waiting for the first request to be
+                # rejected. The Storage object writes the refreshed token back to the file.
+                credentials.refresh(http)
             http = credentials.authorize(http)
             # Construct the service object for the interacting with the Calendar API.
-            self.service = discovery.build('calendar', 'v3', http=http)
+            self.service = discovery.build('calendar', 'v3', http=http, cache_discovery=False)
+            _service = self.service
 
         return self.service
 
@@ -105,7 +131,8 @@ class GCalAdapter(object):
         datetime.datetime(2011, 6, 18, 14, 0))
         {'orderBy': 'updated', 'showDeleted': True, 'calendarId': None, 'timeMin': '2011-06-19T14:00:00',
         'updatedMin': '2011-06-18T14:00:00', 'timeMax': '2011-06-26T14:00:00',
-        'fields': 'items(description,end,id,start,status,summary,updated)', 'singleEvents': True, 'maxResults': 1000}
+        'fields': 'nextPageToken,items(description,end,id,location,start,status,summary)', 'singleEvents': True,
+        'maxResults': 250}
 
         @author Fabrice Bernhard
         @since 2011-06-19
@@ -116,10 +143,11 @@ class GCalAdapter(object):
 
         query = {
             'calendarId': self.calendarId,
-            'maxResults': 1000,
+            'maxResults': 250,
             'orderBy': 'updated',
             'singleEvents': True,
-            'fields': 'items(description,end,id,location,start,status,summary,updated)',
+            # nextPageToken is needed for paging, the event fields are the ones parse_events uses
+            'fields': 'nextPageToken,items(description,end,id,location,start,status,summary)',
             'timeMin': start_min.isoformat(),
             'timeMax': start_max.isoformat(),
         }
@@ -132,24 +160,37 @@ class GCalAdapter(object):
         return query
 
     def query_api(self, queries):
-        """Query the Google Calendar API."""
+        """
+        Query the Google Calendar API.
+        All the queries are packed into a single batch request, and so are their next pages if any.
+        """
 
         logger.info('Submitting query')
 
         entries = []
-        for query in queries:
-            try:
-                page_token = None
-                while True:
-                    query['pageToken'] = page_token
-                    g_cal_events = self.get_service().events().list(**query).execute()
-                    entries += g_cal_events['items']
-                    page_token = g_cal_events.get('nextPageToken')
-                    if not page_token:
-                        break
-            except client.AccessTokenRefreshError:
-                print("The credentials have been revoked or expired, please re-run"
-                      "the application to re-authorize")
+        pending = queries
+        try:
+            service = self.get_service()
+            while pending:
+                next_pages = []
+
+                def callback(request_id, response, exception):
+                    if exception is not None:
+                        raise exception
+                    entries.extend(response['items'])
+                    page_token = response.get('nextPageToken')
+                    if page_token:
+                        query = dict(pending[int(request_id)], pageToken=page_token)
+                        next_pages.append(query)
+
+                batch = service.new_batch_http_request(callback=callback)
+                for i, query in enumerate(pending):
+                    batch.add(service.events().list(**query), request_id=str(i))
+                batch.execute()
+                pending = next_pages
+        except client.AccessTokenRefreshError:
+            print("The credentials have been revoked or expired, please re-run"
+                  "the application to re-authorize")
 
         logger.info('Query results received')
         logger.debug(entries)
@@ -189,7 +230,7 @@ class GCalCron(object):
     """
 
     settings = None
-    settings_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcalcron_conf.json')
+    settings_file = os.path.join(_BASE_DIR, 'gcalcron_conf.json')
 
     def __init__(self, g_cal_adapter=None):
         self.gCalAdapter = g_cal_adapter
@@ -199,6 +240,9 @@ class GCalCron(object):
         try:
             with open(self.settings_file) as f:
                 self.settings = json.load(f)
+            # job dates are kept as ordinals in memory, which makes the daily cleanup a plain integer comparison
+            for job in self.settings['jobs'].values():
+                job['date_ord'] = datetime.date.fromisoformat(job.pop('date')).toordinal()
         except IOError:
             calendar_id = input(
                 'Calendar id (in the form of XXXXX....XXXX@group.calendar.google.com or for the main one just your '
@@ -207,8 +251,15 @@ class GCalCron(object):
             self.save_settings()
 
     def save_settings(self):
-        with open(self.settings_file, 'w') as f:
-            json.dump(self.settings, f, indent=2)
+        # write to a temporary file first so that an interrupted run never leaves a truncated settings file
+        tmp_file = self.settings_file + '.tmp'
+        settings = dict(self.settings, jobs={
+            event_uid: {'date': datetime.date.fromordinal(job['date_ord']).isoformat(), 'ids': job['ids']}
+            for event_uid, job in self.settings['jobs'].items()
+        })
+        with open(tmp_file, 'w') as f:
+            json.dump(settings, f, indent=2)
+        os.replace(tmp_file, self.settings_file)
 
     def init_settings(self, calendar_id):
         self.settings = {
@@ -223,19 +274,16 @@ class GCalCron(object):
     def clean_settings(self):
         """Cleans the settings from saved jobs in the past"""
 
+        cutoff_ord = datetime.date.today().toordinal() - 1
         for event_uid, job in list(self.settings['jobs'].items()):
-            if datetime.datetime.strptime(job['date'], '%Y-%m-%d') <= datetime.datetime.now() - datetime.timedelta(
-                    days=1):
+            if job['date_ord'] <= cutoff_ord:
                 del self.settings['jobs'][event_uid]
 
     def reset_settings(self):
         for event, job in list(self.settings['jobs'].items()):
             command = [u'at', u'-d'] + job['ids']
             logger.debug(command)
-            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = p.communicate()
-            logger.debug(stdout)
-            logger.debug(stderr)
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
         self.settings['last_sync'] = None
         self.settings['jobs'] = {}
         self.save_settings()
@@ -243,45 +291,29 @@ class GCalCron(object):
     def unschedule_old_jobs(self, events):
         removed_job_ids = []
         for event in events:
-            if event['uid'] in self.settings['jobs']:
-                removed_job_ids += self.settings['jobs'][event['uid']]['ids']
-                del self.settings['jobs'][event['uid']]
+            job = self.settings['jobs'].pop(event['uid'], None)
+            if job:
+                removed_job_ids.extend(job['ids'])
         if len(removed_job_ids) > 0:
             command = [u'at', u'-d'] + removed_job_ids
             logger.debug(command)
-            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = p.communicate()
-            logger.debug(stdout)
-            logger.debug(stderr)
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
 
     def schedule_new_jobs(self, events):
-        for event in events:
-            if 'command' not in event:
-                continue
-
-            if event['command']['exec_time'] <= datetime.datetime.now():
-                continue
-
-            cmd = ['at', datetime_to_at(event['command']['exec_time'])]
-            logger.debug(cmd)
-
-            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = p.communicate(event['command']['command'].encode())
-
-            logger.debug(stdout)
-            logger.debug(stderr)
-
-            job_id_match = re.compile('job (\d+) at').search(str(stderr))
+        now = datetime.datetime.now()
+        events = [event for event in events if 'command' in event and event['command']['exec_time'] > now]
 
-            if job_id_match:
-                job_id = job_id_match.group(1)
-                logger.debug('identified job_id: ' + job_id)
+        # the "at" processes are started concurrently, the settings are only updated from this thread
+        with ThreadPoolExecutor() as executor:
+            job_ids = list(executor.map(submit_job, events))
 
+        for event, job_id in zip(events, job_ids):
+            if job_id:
                 if event['uid'] in self.settings['jobs']:
                     self.settings['jobs'][event['uid']]['ids'].append(job_id)
                 else:
                     self.settings['jobs'][event['uid']] = {
-                        'date': event['command']['exec_time'].strftime('%Y-%m-%d'),
+                        'date_ord': event['command']['exec_time'].toordinal(),
                         'ids': [job_id, ]
                     }
 
@@ -298,11 +330,12 @@ class GCalCron(object):
 
         last_sync = None
         if self.settings['last_sync']:
-            last_sync = dateutil.parser.parse(self.settings['last_sync'])
+            last_sync = parse_datetime(self.settings['last_sync'])
 
         sync_start = datetime.datetime.now(gettz())
         events = self.gCalAdapter.get_events(sync_start, last_sync, num_days)
-        command_list = parse_events(events)
+        command_list = list(parse_events(events))
+        logger.debug(command_list)
 
         # first unschedule all modified/deleted events
         self.unschedule_old_jobs(command_list)
@@ -336,12 +369,11 @@ def parse_command(event_description, start_time, end_time, event_summary, event_
     @author Fabrice Bernhard
     @since 2011-06-13
     """
-    command = os.path.abspath(os.path.join(os.path.dirname(__file__), 'gcalcron.sh'))
-    exec_time = dateutil.parser.parse(start_time).replace(tzinfo=None)
+    exec_time = parse_datetime(start_time).replace(tzinfo=None)
     if exec_time >= datetime.datetime.now():
+        args = (_GCALCRON_SH, start_time, end_time, event_summary, event_location, event_description)
         command = {
-            'command': command + ' "' + '" "'.join(
-                [start_time, end_time, event_summary, event_location, event_description]) + '"',
+            'command': ' '.join(shlex.quote(arg) for arg in args),
             'exec_time': exec_time
         }
         return command
@@ -351,26 +383,25 @@ def parse_command(event_description, start_time, end_time, event_summary, event_
 
 def parse_events(events):
     """
-    Transforms the Google Calendar API results into a list of commands
+    Transforms the Google Calendar API results into commands, yielded one event at a time
 
-    >>> parse_events([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime':
+    >>> list(parse_events([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime':
     u'2113-12-23T02:00:00+01:00'}, u'description': u'-60: start_heating.py\\n0: turn_music_on.py\\n+30:
     stop_heating.py', u'summary': u'Wakeup', u'start': {u'dateTime': u'2113-12-23T01:00:00+01:00'},
-    u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}]) [{'commands': [{'exec_time': datetime.datetime(2113, 12, 23, 0, 0),
+    u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}])) [{'commands': [{'exec_time': datetime.datetime(2113, 12, 23, 0, 0),
     'command': u'start_heating.py'}, {'exec_time': datetime.datetime(2113, 12, 23, 1, 0), 'command': u'0:
     turn_music_on.py'}, {'exec_time': datetime.datetime(2113, 12, 23, 1, 30), 'command': u'stop_heating.py'}],
     'uid': u'olbia2urfm1ns0h88v4u0d9a5g'}]
 
-    >>> parse_events([{u'status': u'cancelled', u'updated': u'2013-12-22T19:52:50.525Z',
+    >>> list(parse_events([{u'status': u'cancelled', u'updated': u'2013-12-22T19:52:50.525Z',
      u'end': {u'dateTime': u'2013-12-23T02:00:00+01:00'},
      u'description': u'-60: start_heating.py\\n0: turn_music_on.py\\n+30: stop_heating.py', u'summary': u'Wakeup',
-     u'start': {u'dateTime': u'2013-12-23T01:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}])
+     u'start': {u'dateTime': u'2013-12-23T01:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}]))
     [{'uid': u'olbia2urfm1ns0h88v4u0d9a5g'}]
 
     @author Fabrice Bernhard
     @since 2013-12-22
     """
-    command_list = []
     for event in events:
         start_time = event['start']['dateTime']
         end_time = event['end']['dateTime']
@@ -384,25 +415,60 @@ def parse_events(events):
         if 'summary' in event:
             event_summary = event['summary']
         logger.debug(
-            event['id'] + '-' + event['status'] + '-' + event['updated'] + ': ' + str(start_time) + ' -> ' + str(
+            event['id'] + '-' + event['status'] + ': ' + str(start_time) + ' -> ' + str(
                 end_time) + ' (' + event['start']['dateTime'] + ' -> ' + event['end'][
                 'dateTime'] + ') ' + '=>' + event_description)
         if event['status'] == 'cancelled':
             logger.info("cancelled " + event['id'])
-            command_list.append({
+            yield {
                 'uid': event['id']
-            })
+            }
         else:
             command = parse_command(event_description, start_time, end_time, event_summary, event_location)
             if command:
-                command_list.append({
+                yield {
                     'uid': event['id'],
                     'command': command
-                })
+                }
+
+
+def parse_datetime(value):
+    """
+    Parses the RFC 3339 dates returned by Google with the fast datetime.fromisoformat,
+    falling back on dateutil for the formats it does not support
+
+    >>> parse_datetime('2113-12-23T01:00:00+01:00')
+    datetime.datetime(2113, 12, 23, 1, 0, tzinfo=datetime.timezone(datetime.timedelta(seconds=3600)))
+    >>> parse_datetime('2013-12-22T19:49:13.750Z')
+    datetime.datetime(2013, 12, 22, 19, 49, 13, 750000, tzinfo=datetime.timezone.utc)
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+
+def submit_job(event):
+    """
+    Schedules the command of an event with "at" and returns the job id, or None if it could not be identified
+    """
+    cmd = ['at', datetime_to_at(event['command']['exec_time'])]
+    logger.debug(cmd)
+
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, stderr) = p.communicate(event['command']['command'].encode())
+
+    logger.debug(stdout)
+    logger.debug(stderr)
 
-    logger.debug(command_list)
+    job_id_match = _JOB_RE.search(stderr)
 
-    return command_list
+    if job_id_match:
+        job_id = job_id_match.group(1).decode()
+        logger.debug('identified job_id: ' + job_id)
+        return job_id
 
 
 def datetime_to_at(dt):
@@ -410,7 +476,7 @@ def datetime_to_at(dt):
     >>> datetime_to_at(datetime.datetime(2011, 6, 18, 12, 0))
     '12:00 Jun 18'
     """
-    return dt.strftime('%H:%M %h %d')
+    return '%02d:%02d %s %02d' % (dt.hour, dt.minute, _MONTHS[dt.month - 1], dt.day)
 
 
 def main(argv):
@@ -423,7 +489,7 @@ def main(argv):
     h1.setLevel(level)
     logger.addHandler(h1)
 
-    fh = logging.FileHandler(os.path.join(os.path.dirname(__file__), 'gcalcron.log'))
+    fh = logging.FileHandler(_LOG_FILE)
     fh.setLevel(logging.DEBUG)
     logger.addHandler(fh)
 